@@ -0,0 +1,290 @@
+# Title: Multi-User-Blog benchmark
+# Description: Seeds the local App Engine SDK stubs with users, posts,
+# comments and likes, then drives the routes of blog.app through its
+# WSGI interface and reports latency percentiles, throughput and
+# datastore RPCs per request for each route.
+#
+# Usage:
+#   python benchmark.py --sdk ~/google-cloud-sdk/platform/google_appengine
+#   python benchmark.py --sdk ... --posts 2000 --requests 200 --json out.json
+#
+# Runs entirely offline, nothing is sent to a deployed app.
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import collections
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# (name, method, path builder, needs login)
+ROUTES = [
+    ('front page', 'GET', lambda ctx: '/', False),
+    ('front page (logged in)', 'GET', lambda ctx: '/', True),
+    ('/post', 'GET', lambda ctx: '/post?post_id=%s' % ctx.post_id(), False),
+    ('/comments', 'GET',
+     lambda ctx: '/comments?post_id=%s' % ctx.post_id(), False),
+    ('/myposts', 'GET', lambda ctx: '/myposts', True),
+    ('/search', 'GET', lambda ctx: '/search?q=%s' % ctx.word(), False),
+    ('/feed.atom', 'GET', lambda ctx: '/feed.atom', False),
+    ('/feed.json', 'GET', lambda ctx: '/feed.json', False),
+    ('/like', 'GET', lambda ctx: '/like?post_id=%s' % ctx.post_id(), True),
+    ('/newcomment', 'GET',
+     lambda ctx: '/newcomment?post_id=%s&comment=%s' % (ctx.post_id(),
+                                                       ctx.word()), True),
+    ('/edit', 'POST', lambda ctx: '/edit', True),
+    ('/signup', 'POST', lambda ctx: '/signup', False),
+    ('/login', 'POST', lambda ctx: '/login', False),
+]
+
+WORDS = ("app engine datastore memcache python blog post comment like "
+         "cursor shard index query cache template latency").split()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to the google_appengine SDK folder')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--posts', type=int, default=200)
+    parser.add_argument('--comments', type=int, default=1000)
+    parser.add_argument('--likes', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=50,
+                        help='requests per route')
+    parser.add_argument('--routes', nargs='*',
+                        help='only run routes with these names')
+    parser.add_argument('--cold', action='store_true',
+                        help='flush memcache before every request')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the results here')
+    return parser.parse_args()
+
+
+def setup_sdk(sdk):
+    """
+        puts the SDK and its bundled libraries on sys.path
+    """
+    if not sdk:
+        sys.exit('pass --sdk or set APPENGINE_SDK')
+    sys.path.insert(0, os.path.expanduser(sdk))
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+
+def setup_stubs():
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    return bed
+
+
+class RpcCounter(object):
+    """
+        counts datastore RPCs by method through an apiproxy hook
+    """
+    def __init__(self):
+        self.calls = collections.Counter()
+
+    def install(self):
+        from google.appengine.api import apiproxy_stub_map
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'benchmark', self.hook, 'datastore_v3')
+
+    def hook(self, service, call, request, response):
+        self.calls[call] += 1
+
+    def reset(self):
+        self.calls.clear()
+
+
+class Context(object):
+    """
+        seeded data the route builders pick from
+    """
+    def __init__(self, rng, users, posts):
+        self.rng = rng
+        self.users = users
+        self.posts = posts
+        self.signups = 0
+
+    def post_id(self):
+        return self.rng.choice(self.posts).key().id()
+
+    def word(self):
+        return self.rng.choice(WORDS)
+
+    def text(self, length):
+        return ' '.join(self.rng.choice(WORDS) for _ in xrange(length))
+
+
+def seed(blog, db, args, rng):
+    """
+        writes users, posts, comments and likes the same way the
+        handlers do, using batched puts
+    """
+    users = [blog.User.create('user%d' % i, 'password%d' % i)
+             for i in xrange(args.users)]
+
+    ctx = Context(rng, users, [])
+    for i in xrange(args.posts):
+        author = rng.choice(users)
+        post = blog.Post(parent=blog.posts_key(), subject=ctx.text(4),
+                         content=ctx.text(60), creator_name=author.name,
+                         numLikes=0, numComments=0)
+        post.set_content(post.content)
+        post.put()
+        ctx.posts.append(post)
+    db.put([blog.AuthorPost.for_post(post, blog.User.by_name(
+            post.creator_name)) for post in ctx.posts])
+    blog.index_docs([blog.SearchDoc.for_post(post) for post in ctx.posts])
+
+    comments = []
+    shards = {}
+    for i in xrange(args.comments):
+        post_id = str(ctx.post_id())
+        comments.append(blog.Comment(parent=blog.comments_key(post_id),
+                                     post_id=post_id,
+                                     content=ctx.text(12),
+                                     username=rng.choice(users).name))
+        key = blog.CounterShard.random_key(blog.comments_counter(post_id))
+        shards[key] = blog.CounterShard.add(key, shards.get(key))
+    db.put(comments)
+    blog.index_docs([blog.SearchDoc.for_comment(c) for c in comments])
+
+    likes = {}
+    for i in xrange(args.likes):
+        post_id = str(ctx.post_id())
+        user_id = str(rng.choice(users).key().id())
+        key_name = blog.PostLike.key_name_for(post_id, user_id)
+        if key_name in likes:
+            continue
+        likes[key_name] = blog.PostLike(key_name=key_name, post_id=post_id,
+                                        user_id=user_id)
+        key = blog.CounterShard.random_key(blog.likes_counter(post_id))
+        shards[key] = blog.CounterShard.add(key, shards.get(key))
+    db.put(likes.values())
+    db.put(shards.values())
+    return ctx
+
+
+def build_request(webapp2, blog, ctx, name, method, path, login):
+    headers = {}
+    user = ctx.rng.choice(ctx.users)
+    if login:
+        headers['Cookie'] = 'user_id=%s' % blog.make_secure_val(
+            str(user.key().id()))
+    post = None
+    if name == '/edit':
+        post = ctx.rng.choice([p for p in ctx.posts
+                               if p.creator_name == user.name] or ctx.posts)
+        if post.creator_name != user.name:
+            author = blog.User.by_name(post.creator_name)
+            headers['Cookie'] = 'user_id=%s' % blog.make_secure_val(
+                str(author.key().id()))
+        post = {'post_id': str(post.key().id()), 'subject': ctx.text(4),
+                'content': ctx.text(60)}
+    elif name == '/signup':
+        ctx.signups += 1
+        name = 'bench%d_%d' % (ctx.signups, ctx.rng.randint(0, 10 ** 9))
+        post = {'username': name, 'password': 'password',
+                'verify-password': 'password'}
+    elif name == '/login':
+        index = ctx.users.index(user)
+        post = {'username': user.name, 'password': 'password%d' % index}
+    if method == 'POST':
+        return webapp2.Request.blank(path, headers=headers, POST=post)
+    return webapp2.Request.blank(path, headers=headers)
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[int(round(pct / 100.0 * (len(ordered) - 1)))]
+
+
+def run(blog, args, ctx, rpcs):
+    import webapp2
+    from google.appengine.api import memcache
+
+    results = []
+    for name, method, build_path, login in ROUTES:
+        if args.routes and name not in args.routes:
+            continue
+        timings = []
+        calls = collections.Counter()
+        statuses = collections.Counter()
+        started = time.time()
+        for i in xrange(args.requests):
+            request = build_request(webapp2, blog, ctx, name, method,
+                                    build_path(ctx), login)
+            if args.cold:
+                memcache.flush_all()
+            rpcs.reset()
+            start = time.time()
+            response = request.get_response(blog.app)
+            timings.append((time.time() - start) * 1000)
+            calls.update(rpcs.calls)
+            statuses[response.status_int] += 1
+        elapsed = time.time() - started
+        results.append({
+            'route': name,
+            'requests': args.requests,
+            'p50_ms': percentile(timings, 50),
+            'p90_ms': percentile(timings, 90),
+            'p99_ms': percentile(timings, 99),
+            'mean_ms': sum(timings) / len(timings),
+            'requests_per_sec': args.requests / elapsed,
+            'datastore_rpcs': sum(calls.values()) / float(args.requests),
+            'rpcs_by_method': dict((call, count / float(args.requests))
+                                   for call, count in calls.iteritems()),
+            'statuses': dict(statuses),
+        })
+    return results
+
+
+def report(results):
+    header = '%-24s %9s %9s %9s %9s %9s' % (
+        'route', 'p50 ms', 'p90 ms', 'p99 ms', 'req/s', 'ds rpcs')
+    print header
+    print '-' * len(header)
+    for r in results:
+        print '%-24s %9.1f %9.1f %9.1f %9.1f %9.1f' % (
+            r['route'], r['p50_ms'], r['p90_ms'], r['p99_ms'],
+            r['requests_per_sec'], r['datastore_rpcs'])
+
+
+def main():
+    args = parse_args()
+    setup_sdk(args.sdk)
+    bed = setup_stubs()
+    sys.path.insert(0, ROOT)
+    try:
+        from google.appengine.ext import db
+        import blog
+
+        rng = random.Random(args.seed)
+        ctx = seed(blog, db, args, rng)
+        rpcs = RpcCounter()
+        rpcs.install()
+        results = run(blog, args, ctx, rpcs)
+    finally:
+        bed.deactivate()
+
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f,
+                      indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,19 +9,166 @@
 import os
 import re
 import time
+import datetime
+import json
+import logging
+import threading
+import collections
+import urllib
 from string import letters
 import webapp2
 import jinja2
 import random
 import hmac
 import hashlib
+import binascii
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import db
 
 # -----------------------------Variables--------------------------------------
 secret = "thisIsASecret"
 template_dir = os.path.join(os.path.dirname(__file__), 'templates')
-jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir),
-                               autoescape=True)
+compiled_template_dir = os.path.join(os.path.dirname(__file__),
+                                     'templates_compiled')
+# outside static_build/, files under static handlers are not readable by
+# the app once deployed
+asset_manifest_path = os.path.join(os.path.dirname(__file__),
+                                   'asset_manifest.json')
+PAGE_SIZE = 20
+MIGRATION_BATCH_SIZE = 100
+PURGE_BATCH_SIZE = 500
+EXPORT_BATCH_SIZE = 1000
+CACHE_TIME = 3600
+NUM_COUNTER_SHARDS = 20
+XG_TRANSACTION = db.create_transaction_options(xg=True)
+COMMENT_PREVIEWS = 3
+COMMENT_SNIPPET_LENGTH = 140
+FEED_SIZE = 20
+FEED_FORMATS = {'atom': 'application/atom+xml',
+                'json': 'application/feed+json'}
+USER_CACHE_SIZE = 1000
+USER_CACHE_TIME = 300
+COOKIE_CACHE_SIZE = 5000
+# raise to make password guessing slower, hashes stored with fewer
+# iterations are upgraded on the user's next login
+PW_HASH_SCHEME = 'pbkdf2_sha256'
+PW_HASH_ITERATIONS = 50000
+PW_SALT_LENGTH = 16
+PUBLIC_MAX_AGE = 60
+STATS_FOOTER = os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
+# with WRITE_BEHIND on, comment and like handlers queue their writes
+# for the write-flush queue to apply in batches
+WRITE_BEHIND = False
+WRITE_BEHIND_QUEUE = 'writes'
+WRITE_FLUSH_QUEUE = 'write-flush'
+WRITE_BEHIND_BATCH = 500
+WRITE_BEHIND_LEASE = 60
+WRITE_BEHIND_DELAY = 2
+WRITE_BEHIND_WINDOW = 10
+WRITE_BEHIND_GROUPS = 20
+SEARCH_PAGE_SIZE = 10
+SEARCH_BATCH_SIZE = 500
+SEARCH_STOP_WORDS = frozenset("""a an and are as at be but by for from has
+    have i in is it its my of on or so that the this to was were with you
+    """.split())
+
+
+# -----------------------------Templates--------------------------------------
+class TemplateEngine(object):
+    """
+        Wraps the jinja2 environment. Templates are loaded from the
+        modules built by compile_templates.py when present, compiled
+        bytecode is shared between instances through memcache, and
+        render count and time are recorded per template.
+    """
+    def __init__(self, template_dir, compiled_dir=None):
+        self.file_loader = jinja2.FileSystemLoader(template_dir)
+        loaders = [self.file_loader]
+        if compiled_dir and os.path.isdir(compiled_dir):
+            loaders.insert(0, jinja2.ModuleLoader(compiled_dir))
+        self.env = jinja2.Environment(
+            loader=jinja2.ChoiceLoader(loaders),
+            autoescape=True,
+            auto_reload=False,
+            cache_size=-1,
+            bytecode_cache=jinja2.MemcachedBytecodeCache(memcache.Client(),
+                                                         prefix='jinja2/'))
+        self.counts = collections.defaultdict(int)
+        self.times = collections.defaultdict(float)
+        self.lock = threading.Lock()
+
+    def precompile(self):
+        """
+            compiles every template so requests never pay for it
+        """
+        for name in self.file_loader.list_templates():
+            self.env.get_template(name)
+
+    def render(self, template, **params):
+        return ''.join(self.generate(template, **params))
+
+    def generate(self, template, **params):
+        """
+            yields the rendered template in chunks as jinja2 produces
+            them, recording the time once the last chunk is out
+        """
+        outermost = request_stats.template_started()
+        start = time.time()
+        try:
+            for chunk in self.env.get_template(template).generate(params):
+                yield chunk
+        finally:
+            elapsed = time.time() - start
+            request_stats.template_finished(elapsed, outermost)
+        with self.lock:
+            self.counts[template] += 1
+            self.times[template] += elapsed
+
+    def stats(self):
+        with self.lock:
+            return dict((name, {'renders': count,
+                                'total_ms': self.times[name] * 1000,
+                                'mean_ms': self.times[name] * 1000 / count})
+                        for name, count in self.counts.iteritems())
+
+
+def load_asset_manifest(path):
+    """
+        returns the map of static file names to the fingerprinted names
+        written by build_assets.py, empty when it has not been run
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+
+asset_manifest = load_asset_manifest(asset_manifest_path)
+# part of every cached page key and ETag, so a deploy or an asset
+# rebuild never serves html linking fingerprints that no longer exist
+render_version = hashlib.md5(
+    os.environ.get('CURRENT_VERSION_ID', '') +
+    json.dumps(asset_manifest, sort_keys=True)).hexdigest()[:8]
+
+
+def asset_url(name):
+    """
+        returns the url of a file in static/, pointing at its
+        fingerprinted copy under /assets when one was built
+    """
+    if name in asset_manifest:
+        return '/assets/' + asset_manifest[name]
+    return '/static/' + name
+
+
+template_engine = TemplateEngine(template_dir, compiled_template_dir)
+template_engine.env.globals['asset_url'] = asset_url
+template_engine.precompile()
+jinja_env = template_engine.env
 
 
 # -----------------------------Functions--------------------------------------
@@ -43,42 +190,115 @@ def make_secure_val(val):
 
 def check_secure_val(secure_val):
     """
-        checks the secret against the hash
+        checks the secret against the hash with a constant time
+        compare, values that passed are remembered in verified_cookies
     """
+    val = verified_cookies.get(secure_val)
+    if val:
+        return val
     val = secure_val.split('|')[0]
-    if secure_val == make_secure_val(val):
+    try:
+        valid = hmac.compare_digest(secure_val, make_secure_val(val))
+    except (TypeError, UnicodeError):
+        return None
+    if valid:
+        verified_cookies.set(secure_val, val)
         return val
 
 
+def rfc3339(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
 def render_str(template, **params):
     """
         renders html using template with passed in variables
     """
-    t = jinja_env.get_template(template)
-    return t.render(params)
+    return template_engine.render(template, **params)
+
+
+def reverse_cursor(cursor):
+    """
+        converts a websafe cursor into one for the same query
+        with its sort order reversed
+    """
+    return Cursor.from_websafe_string(cursor).reversed().to_websafe_string()
+
+
+def fetch_page(query, reverse_query, cursor=None, backward=False,
+               page_size=PAGE_SIZE):
+    """
+        fetches one page of query using datastore cursors.
+        reverse_query is the same query with its sort order flipped
+        and is used to walk backwards from cursor.
+        returns (items, prev_cursor, next_cursor)
+    """
+    if backward and cursor:
+        reverse_query.with_cursor(reverse_cursor(cursor))
+        items = reverse_query.fetch(page_size)
+        items.reverse()
+        prev_cursor = None
+        if len(items) == page_size:
+            prev_cursor = reverse_cursor(reverse_query.cursor())
+        return items, prev_cursor, cursor
+
+    if cursor:
+        query.with_cursor(cursor)
+    items = query.fetch(page_size)
+    next_cursor = None
+    if len(items) == page_size:
+        next_cursor = query.cursor()
+    return items, cursor, next_cursor
 
 
 def make_salt(length=5):
     """
-        generates random 5 letter string to use as salt
+        generates random string of length letters to use as salt
     """
     return ''.join(random.choice(letters) for x in xrange(length))
 
 
-def make_pw_hash(name, pw, salt=None):
+def make_legacy_pw_hash(name, pw, salt):
     """
-        combines sale and hash into comma separated string
+        combines salt and sha256 hash into comma separated string,
+        the format used before versioned hashes
     """
-    if not salt:
-        salt = make_salt()
     h = hashlib.sha256(name + pw + salt).hexdigest()
     return '%s,%s' % (salt, h)
 
 
+def make_pw_hash(name, pw, salt=None, iterations=PW_HASH_ITERATIONS):
+    """
+        returns a "scheme$iterations$salt$hash" string using PBKDF2
+    """
+    if not salt:
+        salt = make_salt(PW_SALT_LENGTH)
+    h = hashlib.pbkdf2_hmac('sha256', (name + pw).encode('utf-8'),
+                            str(salt), iterations)
+    return '%s$%d$%s$%s' % (PW_HASH_SCHEME, iterations, salt,
+                            binascii.hexlify(h))
+
+
 def valid_pw(name, password, h):
+    """
+        checks password against a stored hash of either format
+    """
+    if h.startswith(PW_HASH_SCHEME + '$'):
+        scheme, iterations, salt, _ = h.split('$')
+        expected = make_pw_hash(name, password, salt, int(iterations))
+    else:
+        expected = make_legacy_pw_hash(name, password, h.split(',')[0])
+    return hmac.compare_digest(str(h), str(expected))
 
-    salt = h.split(',')[0]
-    return h == make_pw_hash(name, password, salt)
+
+def pw_hash_needs_upgrade(h):
+    """
+        true for legacy hashes and ones with fewer than
+        PW_HASH_ITERATIONS iterations
+    """
+    if not h.startswith(PW_HASH_SCHEME + '$'):
+        return True
+    return int(h.split('$')[1]) < PW_HASH_ITERATIONS
 
 # These methods get keys for their corresponding objects
 
@@ -96,7 +316,282 @@ def blog_key(name='default'):
 
 
 def comments_key(group='default'):
-    return db.Key.from_path('comments', group)
+    """
+        the group is named by the post id as a string. str() makes an
+        int id give the same key instead of a numeric one
+    """
+    return db.Key.from_path('comments', str(group))
+
+
+# -----------------------------Caching----------------------------------------
+# Rendered HTML for anonymous visitors is kept in memcache. Front page
+# keys embed a version number so one incr invalidates every cached page.
+# Stamps record when a page last changed and back its HTTP validators.
+
+
+def post_cache_key(post_id):
+    return 'post-html:%s:%s' % (render_version, post_id)
+
+
+def front_page_version():
+    return memcache.get('front-version') or 0
+
+
+def front_page_cache_key(cursor="", direction=""):
+    return 'front-html:%s:%s:%s:%s' % (render_version, front_page_version(),
+                                       direction, cursor)
+
+
+def get_stamp(name):
+    """
+        returns the time the named page last changed. an unknown or
+        evicted stamp starts now, which only costs clients a refetch
+    """
+    stamp = memcache.get('stamp:' + name)
+    if stamp is None:
+        stamp = time.time()
+        memcache.add('stamp:' + name, stamp)
+    return datetime.datetime.utcfromtimestamp(stamp)
+
+
+def touch_stamp(name):
+    memcache.set('stamp:' + name, time.time())
+
+
+def invalidate_front_page():
+    """
+        drops every cached front page by bumping the version number
+    """
+    memcache.incr('front-version', initial_value=0)
+    touch_stamp('front')
+
+
+def invalidate_feed():
+    """
+        marks the feeds as changed, dropping their rendered copies
+    """
+    touch_stamp('feed')
+
+
+def likes_counter(post_id):
+    return 'likes:%s' % post_id
+
+
+def comments_counter(post_id):
+    return 'comments:%s' % post_id
+
+
+def invalidate_post(post_id):
+    """
+        drops the cached fragment for a post and the pages showing it
+    """
+    memcache.delete(post_cache_key(post_id))
+    touch_stamp('post:%s' % post_id)
+    invalidate_front_page()
+
+
+def invalidate_comments(post_id):
+    """
+        marks the comment pages of a post as changed
+    """
+    touch_stamp('comments:%s' % post_id)
+
+
+class LRUCache(object):
+    """
+        Small thread safe in-process cache that drops the least
+        recently used entry when full and expires entries after ttl
+        seconds
+    """
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.pop(key, None)
+            if entry is None or entry[1] < time.time():
+                return None
+            self.data[key] = entry
+            return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = (value, time.time() + self.ttl)
+            if len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class UserSessionCache(object):
+    """
+        Maps verified user_id cookie values to User entities so that
+        logged in page views skip the datastore. Lookups go to the
+        in-process LRU first, then memcache, then User.by_id.
+    """
+    def __init__(self):
+        self.local = LRUCache(USER_CACHE_SIZE, USER_CACHE_TIME)
+        self.counts = collections.Counter()
+
+    def count(self, name):
+        with self.local.lock:
+            self.counts[name] += 1
+
+    def get(self, cookie_val, uid):
+        user = self.local.get(cookie_val)
+        if user:
+            self.count('local_hits')
+            return user
+        user = memcache.get('session:' + cookie_val)
+        if user:
+            self.count('memcache_hits')
+        else:
+            self.count('misses')
+            user = User.by_id(int(uid))
+            if not user:
+                return None
+            memcache.set('session:' + cookie_val, user, USER_CACHE_TIME)
+        self.local.set(cookie_val, user)
+        return user
+
+    def invalidate(self, cookie_val):
+        self.local.delete(cookie_val)
+        memcache.delete('session:' + cookie_val)
+
+    def invalidate_user(self, user):
+        """
+            drops the cached entry of a user whose entity changed
+        """
+        self.invalidate(make_secure_val(str(user.key().id())))
+
+    def stats(self):
+        with self.local.lock:
+            stats = dict(self.counts)
+            stats['local_size'] = len(self.local.data)
+        return stats
+
+
+session_cache = UserSessionCache()
+verified_cookies = LRUCache(COOKIE_CACHE_SIZE, USER_CACHE_TIME)
+
+
+# ---------------------------Instrumentation----------------------------------
+class RequestStats(object):
+    """
+        Counts datastore RPCs and entities for the request running on
+        the current thread through apiproxy hooks, times its handler
+        and templates, logs one line per request and keeps per route
+        totals for this instance.
+    """
+    def __init__(self):
+        self.local = threading.local()
+        self.routes = {}
+        self.lock = threading.Lock()
+
+    def install(self):
+        apiproxy = apiproxy_stub_map.apiproxy
+        apiproxy.GetPreCallHooks().Append('request-stats', self.pre_call,
+                                          'datastore_v3')
+        apiproxy.GetPostCallHooks().Append('request-stats', self.post_call,
+                                           'datastore_v3')
+
+    def current(self):
+        return getattr(self.local, 'stats', None)
+
+    def start(self):
+        self.local.stats = collections.Counter()
+        self.local.pending = {}
+        self.local.template_depth = 0
+        self.local.start = time.time()
+
+    def add(self, name, value=1):
+        stats = self.current()
+        if stats is not None:
+            stats[name] += value
+
+    def template_started(self):
+        """
+            returns True for the outermost template of a render, so
+            fragments rendered from inside it are not counted twice
+        """
+        depth = getattr(self.local, 'template_depth', 0)
+        self.local.template_depth = depth + 1
+        return depth == 0
+
+    def template_finished(self, elapsed, outermost):
+        self.local.template_depth -= 1
+        if outermost:
+            self.add('template_ms', elapsed * 1000)
+
+    def pre_call(self, service, call, request, response):
+        if self.current() is not None:
+            self.local.pending[id(request)] = time.time()
+
+    def post_call(self, service, call, request, response):
+        stats = self.current()
+        if stats is None:
+            return
+        start = self.local.pending.pop(id(request), None)
+        if start:
+            stats['datastore_ms'] += (time.time() - start) * 1000
+        stats['rpcs'] += 1
+        if call == 'Get':
+            stats['gets'] += 1
+            stats['entities_fetched'] += len(
+                [e for e in response.entity_list() if e.has_entity()])
+        elif call in ('RunQuery', 'Next'):
+            stats['queries' if call == 'RunQuery' else 'query_batches'] += 1
+            stats['entities_fetched'] += response.result_size()
+        elif call == 'Put':
+            stats['puts'] += 1
+            stats['entities_written'] += request.entity_size()
+        elif call == 'Delete':
+            stats['deletes'] += 1
+            stats['entities_written'] += request.key_size()
+
+    def finish(self, method, path, status):
+        """
+            ends the current request, logs its stats as one json line
+            and adds them to the route's totals
+        """
+        stats = self.current()
+        self.local.stats = None
+        stats['handler_ms'] = (time.time() - self.local.start) * 1000
+        route = '%s %s' % (method, path)
+        logging.info('request_stats %s', json.dumps(
+            dict(stats, route=route, status=status), sort_keys=True))
+        with self.lock:
+            totals = self.routes.setdefault(route, collections.Counter())
+            totals['requests'] += 1
+            totals['max_handler_ms'] = max(totals['max_handler_ms'],
+                                           stats['handler_ms'])
+            totals.update(stats)
+        return stats
+
+    def stats(self):
+        with self.lock:
+            result = {}
+            for route, totals in self.routes.iteritems():
+                count = totals['requests']
+                result[route] = dict(
+                    (name, value if name in ('requests', 'max_handler_ms')
+                     else float(value) / count)
+                    for name, value in totals.iteritems())
+            return result
+
+
+request_stats = RequestStats()
+request_stats.install()
 
 
 # ----------------------Base Class----------------------------------
@@ -117,9 +612,38 @@ class BaseHandler(webapp2.RequestHandler):
 
     def render(self, template, **kw):
         """
-            helper function that calls render_str
+            writes the template's output to the response chunk by chunk
+            instead of building the whole page first
         """
-        self.write(self.render_str(template, **kw))
+        for chunk in template_engine.generate(template, **kw):
+            self.write(chunk)
+
+    def dispatch(self):
+        request_stats.start()
+        status = 500
+        try:
+            webapp2.RequestHandler.dispatch(self)
+            status = self.response.status_int
+        except Exception as e:
+            status = getattr(e, 'code', 500)
+            raise
+        finally:
+            stats = request_stats.finish(self.request.method,
+                                         self.request.path, status)
+        if STATS_FOOTER:
+            self.write_stats_footer(stats)
+
+    def write_stats_footer(self, stats):
+        """
+            appends this request's stats to html pages, only enabled
+            on the development server
+        """
+        if (self.response.status_int != 200 or
+                self.response.content_type != 'text/html'):
+            return
+        self.write('<div class="request-stats">%s</div>' % ' '.join(
+            '%s=%s' % (name, round(value, 1))
+            for name, value in sorted(stats.iteritems())))
 
     def set_secure_cookie(self, name, val):
         """
@@ -148,15 +672,101 @@ class BaseHandler(webapp2.RequestHandler):
         """
             deletes cookie to log user out
         """
+        cookie_val = self.request.cookies.get('user_id')
+        if cookie_val:
+            session_cache.invalidate(cookie_val)
         self.response.headers.add_header('Set-Cookie', 'user_id=; Path=/')
 
+    def not_modified(self, parts, last_modified):
+        """
+            sets ETag, Last-Modified and Cache-Control for the page that
+            parts describe. returns True and prepares a 304 response if
+            the client's copy is current, so rendering can be skipped
+        """
+        parts = list(parts) + [self.user and self.user.key().id(),
+                               render_version]
+        etag = hashlib.md5(repr(parts)).hexdigest()
+        last_modified = last_modified.replace(microsecond=0)
+        self.response.etag = etag
+        self.response.last_modified = last_modified
+        self.response.headers['Vary'] = 'Cookie'
+        if self.user:
+            self.response.headers['Cache-Control'] = 'private, no-cache'
+        else:
+            self.response.headers['Cache-Control'] = \
+                'public, max-age=%d' % PUBLIC_MAX_AGE
+
+        if self.request.if_none_match:
+            fresh = etag in self.request.if_none_match
+        else:
+            since = self.request.if_modified_since
+            fresh = bool(since and
+                         last_modified <= since.replace(tzinfo=None))
+        if fresh:
+            self.response.status = 304
+        return fresh
+
+    def get_post(self, post_id=None):
+        """
+            resolves the post_id request parameter to a Post,
+            aborting with 404 if it is missing or unknown
+        """
+        if post_id is None:
+            post_id = self.request.get("post_id")
+        if not post_id.isdigit():
+            self.abort(404)
+        post = Post.by_id(post_id)
+        if not post:
+            self.abort(404)
+        return post
+
+    def get_comment(self, post_id, comment_id=None):
+        """
+            resolves the comment_id request parameter to a Comment
+            on the given post, aborting with 404 if it is unknown
+        """
+        if comment_id is None:
+            comment_id = self.request.get("comment_id")
+        if not comment_id.isdigit():
+            self.abort(404)
+        comment = Comment.by_id(comment_id, post_id)
+        if not comment:
+            self.abort(404)
+        return comment
+
+    def get_post_and_comment(self, post_id, comment_id):
+        """
+            resolves a post and one of its comments with a single
+            batched get, aborting with 404 if either is unknown
+        """
+        if not (post_id.isdigit() and comment_id.isdigit()):
+            self.abort(404)
+        post, legacy_post, comment, legacy_comment = db.get(
+            Post.keys_for(post_id) + Comment.keys_for(comment_id, post_id))
+        if not (post or legacy_post) or not (comment or legacy_comment):
+            self.abort(404)
+        return post or legacy_post, comment or legacy_comment
+
+    def paginate(self, query, reverse_query):
+        """
+            fetches the page of query selected by the cursor and dir
+            request parameters, returns (items, prev_cursor, next_cursor)
+        """
+        cursor = self.request.get("cursor") or None
+        backward = self.request.get("dir") == "prev"
+        try:
+            return fetch_page(query, reverse_query, cursor, backward)
+        except (db.BadRequestError, db.BadValueError, TypeError):
+            self.abort(400)
+
     def initialize(self, *a, **kw):
         """
             checks if user is logged in
         """
         webapp2.RequestHandler.initialize(self, *a, **kw)
-        uid = self.read_secure_cookie('user_id')
-        self.user = uid and User.by_id(int(uid))
+        cookie_val = self.request.cookies.get('user_id')
+        uid = cookie_val and check_secure_val(cookie_val)
+        self.user = uid and session_cache.get(cookie_val, uid)
 
 # -----------------------CLASSES FOR OBJECTS----------------------------------
 
@@ -180,8 +790,16 @@ class User(db.Model):
 
     @classmethod
     def by_name(cls, name):
-        u = User.all().filter('name =', name).get()
-        return u
+        """
+            returns user through the Username entity, falling back to
+            a query for users created before usernames were reserved
+        """
+        username = Username.by_name(name)
+        # a Username reserved for a differently named user must not
+        # hide a legacy user that has none yet
+        if username and username.user.name == name:
+            return username.user
+        return User.all().ancestor(users_key()).filter('name =', name).get()
 
     @classmethod
     def register(cls, name, pw):
@@ -190,13 +808,63 @@ class User(db.Model):
                     name=name,
                     pw_hash=pw_hash)
 
+    @classmethod
+    def create(cls, name, pw):
+        """
+            registers and stores a user together with its Username in
+            one transaction, returns None if the name is already taken
+        """
+        # hashing is slow, keep it out of the shared users_key() group's
+        # transaction and its retries
+        u = cls.register(name, pw)
+
+        def txn():
+            # by_name also finds users that have no Username yet, its
+            # fallback query stays in the users_key() group
+            if cls.by_name(name):
+                return None
+            u.put()
+            Username(key_name=Username.normalize(name), parent=users_key(),
+                     user=u).put()
+            return u
+        return db.run_in_transaction(txn)
+
     @classmethod
     def login(cls, name, pw):
+        """
+            checks the password and rehashes it with the current
+            scheme when it was stored with an older one
+        """
         u = cls.by_name(name)
-        if u and valid_pw(name, pw, u.pw_hash):
+        if u and valid_pw(u.name, pw, u.pw_hash):
+            if pw_hash_needs_upgrade(u.pw_hash):
+                u.pw_hash = make_pw_hash(u.name, pw)
+                u.put()
+                session_cache.invalidate_user(u)
             return u
 
 
+class Username(db.Model):
+    """
+        Username reserves a user name. Its key name is the name without
+        surrounding whitespace, so names stay case sensitive as they
+        were before usernames were reserved. It lives in the users_key()
+        group next to its User, so both are created in the same
+        transaction.
+        Attributes:
+            user (ref): The user owning the name
+    """
+    user = db.ReferenceProperty(User, required=True)
+
+    @staticmethod
+    def normalize(name):
+        return name.strip()
+
+    @classmethod
+    def by_name(cls, name):
+        return cls.get_by_key_name(cls.normalize(name), parent=users_key())
+
+
 class Post(db.Expando):
     """
         Post class holds information about each post
@@ -205,15 +873,20 @@ class Post(db.Expando):
             creator_name (str): Username of user that posted comment
             subject (str): Subject line of post
             content (text): Main text content of the post
+            content_html (text): content with new lines as html <br>,
+                                 computed when the post is written
             created (DateTime): Date/Time of post creation
-            likers (strlist): List of user ID's who have liked the post
-            numLikes(int): Number of likes for the posts_key
+            likers (strlist): User ID's who liked the post before likes
+                              were stored as PostLike entities
+            numLikes(int): Likes counted before the sharded like counter
             comments(strlist): List of comments ID's on the post
-            numComments(int): Number of comments on the post
+            numComments(int): Comments counted before the sharded
+                              comment counter
     """
     creator_name = db.StringProperty(required=True)
     subject = db.StringProperty(required=True)
     content = db.TextProperty(required=True)
+    content_html = db.TextProperty()
     created = db.DateTimeProperty(auto_now_add=True)
     last_modified = db.DateTimeProperty(auto_now=True)
     likers = db.StringListProperty()
@@ -224,15 +897,155 @@ class Post(db.Expando):
     @classmethod
     def by_id(cls, post_id):
         """
-            returns comment from id
+            returns post from id with a single batched get, falling back
+            to posts that were stored without the posts_key() parent
+        """
+        post, legacy = db.get(cls.keys_for(post_id))
+        return post or legacy
+
+    @staticmethod
+    def keys_for(post_id):
+        """
+            returns the key of a post and its key from before posts
+            were stored under posts_key()
+        """
+        post_id = int(post_id)
+        return [db.Key.from_path('Post', post_id, parent=posts_key()),
+                db.Key.from_path('Post', post_id)]
+
+    @classmethod
+    def recent(cls, order='-created'):
+        """
+            returns strongly consistent ancestor query over all posts
+        """
+        return cls.all().ancestor(posts_key()).order(order)
+
+    @classmethod
+    def by_ids(cls, post_ids):
+        """
+            returns posts for a list of ids using one batched get,
+            None for ids that do not exist
+        """
+        keys = []
+        for post_id in post_ids:
+            keys += cls.keys_for(post_id)
+        entities = db.get(keys)
+        return [entities[i] or entities[i + 1]
+                for i in xrange(0, len(entities), 2)]
+
+    @classmethod
+    def prefetch(cls, posts, user=None):
         """
-        return Post.get_by_id(post_id, parent=posts_key())
+            prepares a page of posts for rendering. cached fragments and
+            counter totals come from one memcache call, then missing
+            counter shards, comment summaries and the user's likes from
+            one batched get. returns the set of ids of the posts liked
+            by user
+        """
+        fragment_keys = [post_cache_key(post.key().id()) for post in posts]
+        names = cls.counter_names(posts)
+        cached = memcache.get_multi(fragment_keys +
+                                    ['counter:' + name for name in names])
+        for post, key in zip(posts, fragment_keys):
+            # False marks a fragment already known to be missing
+            post._fragment = cached.get(key, False)
+
+        # counts are only needed for fragments that must be rendered
+        to_render = [post for post in posts
+                     if post._fragment is False]
+        counts = {}
+        missing = []
+        for name in cls.counter_names(to_render):
+            if 'counter:' + name in cached:
+                counts[name] = cached['counter:' + name]
+            else:
+                missing.append(name)
+        keys = counter_shard_keys(missing)
+        like_keys = user and PostLike.keys_for(posts, user) or []
+        summary_keys = [CommentSummary.key_for(post.key().id())
+                        for post in to_render]
+        all_keys = keys + like_keys + summary_keys
+        entities = db.get(all_keys) if all_keys else []
+        counts.update(sum_counter_shards(missing, entities[:len(keys)]))
+        cls.set_counts(to_render, counts)
+        for post, summary in zip(to_render,
+                                 entities[len(keys) + len(like_keys):]):
+            post._summary = summary
+        if user:
+            return PostLike.liked_post_ids(
+                posts, user, entities[len(keys):len(keys) + len(like_keys)])
+        return set()
+
+    @staticmethod
+    def counter_names(posts):
+        names = []
+        for post in posts:
+            post_id = post.key().id()
+            names += [likes_counter(post_id), comments_counter(post_id)]
+        return names
+
+    @classmethod
+    def load_counts(cls, posts):
+        """
+            loads like and comment totals for a list of posts
+            with one memcache call and at most one batched get
+        """
+        cls.set_counts(posts, get_counts(cls.counter_names(posts)))
+
+    @staticmethod
+    def set_counts(posts, counts):
+        for post in posts:
+            post_id = post.key().id()
+            post._likes = ((post.numLikes or 0) +
+                           counts[likes_counter(post_id)])
+            post._comments = ((post.numComments or 0) +
+                              counts[comments_counter(post_id)])
+
+    def like_count(self):
+        if not hasattr(self, '_likes'):
+            Post.load_counts([self])
+        return self._likes
+
+    def comment_count(self):
+        if not hasattr(self, '_comments'):
+            Post.load_counts([self])
+        return self._comments
+
+    def comment_summary(self):
+        if not hasattr(self, '_summary'):
+            self._summary = CommentSummary.get(
+                CommentSummary.key_for(self.key().id()))
+        return self._summary
 
     def render(self, user=None, post_id=None, username="", *a, **kw):
         """
-            replaces new lines with html <br> then renders page
+            renders the post.html fragment.
+            the anonymous version is cached in memcache
+        """
+        if user:
+            return self.render_fragment(user, post_id)
+        html = getattr(self, '_fragment', None)
+        if html is None:
+            html = memcache.get(post_cache_key(self.key().id()))
+        if html is None or html is False:
+            html = self.render_fragment()
+            memcache.set(post_cache_key(self.key().id()), html, CACHE_TIME)
+        self._fragment = html
+        return html
+
+    def set_content(self, content):
+        """
+            stores content together with its html version
         """
-        self._render_text = self.content.replace('\n', '<br>')
+        self.content = content
+        self.content_html = content.replace('\n', '<br>')
+
+    def body_html(self):
+        if self.content_html is None:
+            return self.content.replace('\n', '<br>')
+        return self.content_html
+
+    def render_fragment(self, user=None, post_id=None):
         return render_str("post.html", p=self, user=user, post_id=post_id)
 
 
@@ -252,37 +1065,979 @@ class Comment(db.Model):
     username = db.StringProperty()
 
     @classmethod
-    def by_id(cls, post_id):
-        return cls.get_by_id(post_id, parent=posts_key())
+    def by_id(cls, comment_id, post_id):
+        """
+            returns comment from id, falling back to comments that
+            were stored without the comments_key() parent
+        """
+        comment, legacy = db.get(cls.keys_for(comment_id, post_id))
+        return comment or legacy
+
+    @staticmethod
+    def keys_for(comment_id, post_id):
+        """
+            returns the key of a comment and its key from before
+            comments were stored under comments_key()
+        """
+        comment_id = int(comment_id)
+        return [db.Key.from_path('Comment', comment_id,
+                                 parent=comments_key(post_id)),
+                db.Key.from_path('Comment', comment_id)]
+
+    @staticmethod
+    def allocate_key(post_id):
+        """
+            returns the key for a new comment with its id allocated up
+            front, so the comment can be written in the same batch as
+            entities that refer to it
+        """
+        group = comments_key(post_id)
+        comment_id = db.allocate_ids(db.Key.from_path('Comment', 1,
+                                                      parent=group), 1)[0]
+        return db.Key.from_path('Comment', comment_id, parent=group)
+
+    @classmethod
+    def for_post(cls, post_id, order='-created'):
+        """
+            returns ancestor query for the comments of one post
+        """
+        return cls.all().ancestor(comments_key(post_id)).order(order)
+
+
+class CommentSummary(db.Model):
+    """
+        CommentSummary keeps the comment count and the newest comments
+        of a post so list pages can show previews without querying
+        Comment. It lives in the post's comments_key() group and is
+        written in the same transaction as the comments.
+        Attributes:
+            count(int): Number of comments on the post
+            latest(text): JSON list of up to COMMENT_PREVIEWS previews,
+                          newest first, with id, username, snippet
+                          and created
+    """
+    count = db.IntegerProperty(default=0)
+    latest = db.TextProperty(default='[]')
+
+    @staticmethod
+    def key_for(post_id):
+        return db.Key.from_path('CommentSummary', 'summary',
+                                parent=comments_key(post_id))
+
+    @classmethod
+    def build(cls, post_id):
+        """
+            computes the summary from the stored comments, runs inside
+            the transaction of the first comment change of a post that
+            has none yet
+        """
+        query = Comment.for_post(post_id)
+        summary = cls(key=cls.key_for(post_id), count=query.count(None))
+        summary.set_previews([cls.preview(comment)
+                              for comment in query.fetch(COMMENT_PREVIEWS)])
+        return summary
+
+    @staticmethod
+    def preview(comment):
+        snippet = comment.content
+        if len(snippet) > COMMENT_SNIPPET_LENGTH:
+            snippet = snippet[:COMMENT_SNIPPET_LENGTH].rstrip() + '...'
+        return {'id': comment.key().id(), 'username': comment.username,
+                'snippet': snippet, 'created': comment.created.isoformat()}
+
+    def previews(self):
+        if not hasattr(self, '_previews'):
+            self._previews = json.loads(self.latest)
+        return self._previews
+
+    def set_previews(self, previews):
+        self._previews = previews[:COMMENT_PREVIEWS]
+        self.latest = json.dumps(self._previews)
+
+    def add(self, comment):
+        self.count += 1
+        self.set_previews([self.preview(comment)] + self.previews())
+
+    def update(self, comment):
+        comment_id = comment.key().id()
+        self.set_previews([self.preview(comment) if p['id'] == comment_id
+                           else p for p in self.previews()])
+
+    def remove(self, comment, deleted=()):
+        """
+            drops comment, refilling the previews from the stored
+            comments when it was one of them. deleted are the keys of
+            other comments removed in the same transaction
+        """
+        self.count = max(self.count - 1, 0)
+        comment_id = comment.key().id()
+        previews = [p for p in self.previews() if p['id'] != comment_id]
+        if len(previews) < len(self.previews()) and self.count > len(previews):
+            skip = set(deleted) | set([comment.key()])
+            shown = set(p['id'] for p in previews)
+            for stored in Comment.for_post(comment.post_id).fetch(
+                    COMMENT_PREVIEWS + len(skip)):
+                if stored.key() not in skip and stored.key().id() not in shown:
+                    previews.append(self.preview(stored))
+            previews.sort(key=lambda p: p['created'], reverse=True)
+        self.set_previews(previews)
+
+
+class FeedSnapshot(db.Model):
+    """
+        FeedSnapshot holds the newest FEED_SIZE posts as they appear in
+        /feed.atom and /feed.json. It lives in the posts_key() group and
+        is updated in the transaction that creates, edits or deletes a
+        post, so serving the feeds never queries Post.
+        Attributes:
+            latest(text): JSON list of entries, newest first, with id,
+                          title, author, content_html, published
+                          and updated
+            updated(DateTime): Time of the last change
+    """
+    latest = db.TextProperty(default='[]')
+    updated = db.DateTimeProperty(auto_now=True)
+
+    @staticmethod
+    def key_for():
+        return db.Key.from_path('FeedSnapshot', 'posts', parent=posts_key())
+
+    @classmethod
+    def load(cls):
+        """
+            returns the snapshot, building it from the newest posts when
+            there is none yet. meant to run inside a transaction
+        """
+        snapshot = cls.get(cls.key_for())
+        if not snapshot:
+            snapshot = cls(key=cls.key_for())
+            snapshot.set_entries([cls.entry(post) for post in
+                                  Post.recent().fetch(FEED_SIZE)])
+        return snapshot
+
+    @classmethod
+    def current(cls):
+        """
+            returns the stored snapshot, storing it the first time
+        """
+        def txn():
+            snapshot = cls.load()
+            if not snapshot.is_saved():
+                snapshot.put()
+            return snapshot
+        return cls.get(cls.key_for()) or db.run_in_transaction(txn)
+
+    @staticmethod
+    def entry(post):
+        return {'id': post.key().id(), 'title': post.subject,
+                'author': post.creator_name,
+                'content_html': post.body_html(),
+                'published': rfc3339(post.created),
+                'updated': rfc3339(post.last_modified)}
+
+    def entries(self):
+        if not hasattr(self, '_entries'):
+            self._entries = json.loads(self.latest)
+        return self._entries
+
+    def set_entries(self, entries):
+        self._entries = entries[:FEED_SIZE]
+        self.latest = json.dumps(self._entries)
+
+    def add(self, post):
+        self.set_entries([self.entry(post)] + self.entries())
+
+    def update(self, post):
+        post_id = post.key().id()
+        entry = self.entry(post)
+        # last_modified on the instance keeps its old value after a put
+        entry['updated'] = rfc3339(datetime.datetime.utcnow())
+        self.set_entries([entry if e['id'] == post_id else e
+                          for e in self.entries()])
+
+    def remove(self, post):
+        """
+            drops post, refilling from the stored posts when it was in
+            the feed. inside the transaction the query still sees it
+        """
+        post_id = post.key().id()
+        entries = [e for e in self.entries() if e['id'] != post_id]
+        if len(entries) < len(self.entries()):
+            shown = set(e['id'] for e in entries) | set([post_id])
+            for stored in Post.recent().fetch(FEED_SIZE + 1):
+                if stored.key().id() not in shown:
+                    entries.append(self.entry(stored))
+            entries.sort(key=lambda e: e['published'], reverse=True)
+        self.set_entries(entries)
+
+    def render(self, fmt, base_url):
+        """
+            returns the feed as Atom or JSON Feed
+        """
+        if fmt == 'json':
+            return json.dumps({
+                'version': 'https://jsonfeed.org/version/1.1',
+                'title': 'Multi User Blog',
+                'home_page_url': base_url + '/',
+                'feed_url': base_url + '/feed.json',
+                'items': [{'id': str(e['id']),
+                           'url': '%s/post?post_id=%s' % (base_url, e['id']),
+                           'title': e['title'],
+                           'content_html': e['content_html'],
+                           'date_published': e['published'],
+                           'date_modified': e['updated'],
+                           'authors': [{'name': e['author']}]}
+                          for e in self.entries()]})
+        return render_str('feed.atom', entries=self.entries(),
+                          base_url=base_url, updated=rfc3339(self.updated))
+
+
+class AuthorPost(db.Model):
+    """
+        AuthorPost lists a post under its author. It is stored under the
+        author's User key with the post id as key name, so an author's
+        posts come from one strongly consistent ancestor query.
+        Attributes:
+            created(DateTime): Creation time of the post
+    """
+    created = db.DateTimeProperty(required=True)
+
+    @classmethod
+    def for_post(cls, post, user):
+        return cls(key_name=str(post.key().id()), parent=user,
+                   created=post.created)
+
+    @classmethod
+    def key_for(cls, post, user):
+        return db.Key.from_path(cls.kind(), str(post.key().id()),
+                                parent=user.key())
+
+    @classmethod
+    def for_author(cls, user, order='-created'):
+        """
+            returns keys only ancestor query over an author's posts,
+            the key names are the post ids
+        """
+        return cls.all(keys_only=True).ancestor(user).order(order)
+
+
+class CounterShard(db.Model):
+    """
+        CounterShard holds one slice of a sharded counter so that
+        concurrent updates to the same counter rarely touch the same
+        entity. Key names are "<counter name>:<shard index>".
+        Attributes:
+            count(int): This shard's part of the total
+    """
+    count = db.IntegerProperty(default=0)
+
+    @classmethod
+    def shard_keys(cls, name):
+        return [db.Key.from_path(cls.kind(), '%s:%d' % (name, index))
+                for index in xrange(NUM_COUNTER_SHARDS)]
+
+    @classmethod
+    def random_key(cls, name):
+        index = random.randint(0, NUM_COUNTER_SHARDS - 1)
+        return db.Key.from_path(cls.kind(), '%s:%d' % (name, index))
+
+    @classmethod
+    def add(cls, key, shard, delta=1):
+        """
+            returns the shard fetched for key (None if it does not exist
+            yet) with delta added. the caller puts it, together with its
+            other writes, inside a transaction
+        """
+        shard = shard or cls(key=key)
+        shard.count += delta
+        return shard
+
+
+class PostLike(db.Model):
+    """
+        PostLike records that a user liked a post. The key name is
+        "<post id>:<user id>" so checking or toggling a like is a
+        single key operation.
+        Attributes:
+            post_id(str): ID of the liked post
+            user_id(str): ID of the user who liked it
+            created(DateTime): Time of the like
+    """
+    post_id = db.StringProperty(required=True)
+    user_id = db.StringProperty(required=True)
+    created = db.DateTimeProperty(auto_now_add=True)
+
+    @staticmethod
+    def key_name_for(post_id, user_id):
+        return '%s:%s' % (post_id, user_id)
+
+    @classmethod
+    def keys_for(cls, posts, user):
+        user_id = user.key().id()
+        return [db.Key.from_path(cls.kind(),
+                                 cls.key_name_for(post.key().id(), user_id))
+                for post in posts]
+
+    @classmethod
+    def liked_post_ids(cls, posts, user, likes=None):
+        """
+            returns the ids of posts in the list liked by user. likes
+            are the entities for keys_for(posts, user) and are fetched
+            with one batched get when not given
+        """
+        user_id = user.key().id()
+        if likes is None:
+            likes = db.get(cls.keys_for(posts, user))
+        post_ids = [post.key().id() for post in posts]
+        liked = set(post_id for post_id, like in zip(post_ids, likes) if like)
+        for post in posts:
+            if str(user_id) in post.likers:
+                liked.add(post.key().id())
+        return liked
+
+
+def counter_shard_keys(names):
+    keys = []
+    for name in names:
+        keys += CounterShard.shard_keys(name)
+    return keys
+
+
+def sum_counter_shards(names, shards):
+    """
+        adds up the shards fetched for counter_shard_keys(names)
+        and caches the totals
+    """
+    totals = {}
+    for i, name in enumerate(names):
+        group = shards[i * NUM_COUNTER_SHARDS:(i + 1) * NUM_COUNTER_SHARDS]
+        totals[name] = sum(shard.count for shard in group if shard)
+    if totals:
+        memcache.add_multi(totals, CACHE_TIME, key_prefix='counter:')
+    return totals
+
+
+def get_counts(names):
+    """
+        returns dict of counter totals, read from memcache and
+        falling back to a single batched get of every shard
+    """
+    counts = memcache.get_multi(names, key_prefix='counter:')
+    missing = [name for name in names if name not in counts]
+    if missing:
+        counts.update(sum_counter_shards(missing,
+                                         db.get(counter_shard_keys(missing))))
+    return counts
+
+
+def update_count_cache(name, delta):
+    """
+        applies a committed counter change to the cached total
+    """
+    if delta > 0:
+        memcache.incr('counter:' + name, delta)
+    else:
+        # memcache cannot go below zero, so reload from the shards
+        memcache.delete('counter:' + name)
+
+
+def bump_count_cache(name, delta):
+    """
+        applies a queued counter change to the cached total so it
+        shows before the write lands, the cache is reloaded from the
+        shards once it does
+    """
+    if delta > 0:
+        memcache.incr('counter:' + name, delta)
+    else:
+        memcache.decr('counter:' + name, -delta)
+
+
+# --------------------------------SEARCH--------------------------------------
+# Every post and comment has a SearchDoc whose terms list property acts
+# as the inverted index: a query with one equality filter per term is
+# answered by a merge join over the built-in index, and the candidates
+# are then ranked with the stored term weights.
+
+
+def tokenize(text):
+    return [word for word in re.findall(r'\w+', text.lower(), re.UNICODE)
+            if len(word) > 1 and word not in SEARCH_STOP_WORDS]
+
+
+class SearchDoc(db.Model):
+    """
+        SearchDoc holds the indexed terms of one post or comment.
+        Attributes:
+            post_id(str): ID of the post the document belongs to
+            terms(strlist): Distinct terms of the document
+            weights(text): JSON object of term weights used for ranking
+    """
+    post_id = db.StringProperty(required=True)
+    terms = db.StringListProperty()
+    weights = db.TextProperty()
+
+    @classmethod
+    def build(cls, key_name, post_id, fields):
+        """
+            builds the document for a list of (text, weight) fields
+        """
+        weights = collections.defaultdict(float)
+        for text, weight in fields:
+            for term in tokenize(text):
+                weights[term] += weight
+        return cls(key_name=key_name, post_id=str(post_id),
+                   terms=sorted(weights), weights=json.dumps(weights))
+
+    @classmethod
+    def for_post(cls, post):
+        post_id = post.key().id()
+        return cls.build('post:%s' % post_id, post_id,
+                         [(post.subject, 3), (post.content, 1)])
+
+    @classmethod
+    def for_comment(cls, comment):
+        return cls.build(cls.comment_key_name(comment), comment.post_id,
+                         [(comment.content, 1)])
+
+    @staticmethod
+    def comment_key_name(comment):
+        return 'comment:%s:%s' % (comment.post_id, comment.key().id())
+
+
+def index_docs(docs):
+    db.put(docs)
+    memcache.incr('search-version', initial_value=0)
+
+
+def unindex_post(post_id):
+    """
+        drops the documents of a post and all of its comments
+    """
+    query = SearchDoc.all(keys_only=True).filter('post_id =', str(post_id))
+    db.delete(list(query.run(batch_size=PURGE_BATCH_SIZE)))
+    memcache.incr('search-version', initial_value=0)
+
+
+def unindex_comment(comment):
+    db.delete(db.Key.from_path('SearchDoc',
+                               SearchDoc.comment_key_name(comment)))
+    memcache.incr('search-version', initial_value=0)
+
+
+def search(text, page=0):
+    """
+        returns the post ids on one page of results for text, ranked by
+        the summed weights of the query terms in each post and its
+        comments, and whether more pages follow
+    """
+    terms = sorted(set(tokenize(text)))
+    if not terms:
+        return [], False
+    key = 'search:%s:%s' % (memcache.get('search-version') or 0,
+                            hashlib.md5(' '.join(terms).encode('utf-8'))
+                            .hexdigest())
+    ranked = memcache.get(key)
+    if ranked is None:
+        # every match is ranked, a capped fetch would only see the
+        # first documents in key order
+        query = SearchDoc.all(keys_only=True)
+        for term in terms:
+            query.filter('terms =', term)
+        keys = list(query.run(batch_size=SEARCH_BATCH_SIZE))
+        scores = collections.defaultdict(float)
+        rpcs = [db.get_async(keys[i:i + SEARCH_BATCH_SIZE])
+                for i in xrange(0, len(keys), SEARCH_BATCH_SIZE)]
+        for rpc in rpcs:
+            for doc in rpc.get_result():
+                if doc:
+                    weights = json.loads(doc.weights)
+                    scores[doc.post_id] += sum(weights.get(term, 0)
+                                               for term in terms)
+        ranked = sorted(scores, key=lambda post_id: (-scores[post_id],
+                                                     -int(post_id)))
+        memcache.set(key, ranked, CACHE_TIME)
+    start = page * SEARCH_PAGE_SIZE
+    end = start + SEARCH_PAGE_SIZE
+    return ranked[start:end], len(ranked) > end
+
+
+# ------------------------------WRITE BEHIND----------------------------------
+# Comment and like mutations are queued as pull tasks named after their
+# content, so a repeated submit within WRITE_BEHIND_WINDOW seconds is
+# dropped. A named push task per WRITE_BEHIND_DELAY seconds leases them,
+# and every mutation checks the stored state before applying, so leases
+# that expire after a failure are simply applied again.
+
+
+def queue_write(mutation, *dedup):
+    """
+        queues a mutation for apply_queued_writes and schedules a
+        flush, returns False if the same mutation was queued moments ago
+    """
+    mutation['ts'] = time.time()
+    name = '%s-%s-%d' % (mutation['op'],
+                         hashlib.md5(json.dumps(dedup)).hexdigest(),
+                         mutation['ts'] // WRITE_BEHIND_WINDOW)
+    task = taskqueue.Task(payload=json.dumps(mutation), method='PULL',
+                          name=name)
+    try:
+        taskqueue.Queue(WRITE_BEHIND_QUEUE).add(task)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        return False
+    schedule_flush()
+    return True
+
+
+def schedule_flush():
+    """
+        adds at most one flush task per WRITE_BEHIND_DELAY seconds
+    """
+    bucket = int(time.time() // WRITE_BEHIND_DELAY)
+    try:
+        taskqueue.add(queue_name=WRITE_FLUSH_QUEUE, url='/_writes',
+                      name='flush-%d' % bucket, countdown=WRITE_BEHIND_DELAY)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def queue_new_comment(comment):
+    """
+        queues comment, whose id was allocated up front, so applying it
+        twice finds the first copy
+    """
+    return queue_write({'op': 'comment', 'post_id': comment.post_id,
+                        'comment_key': str(comment.key()),
+                        'content': comment.content,
+                        'username': comment.username},
+                       comment.post_id, comment.username, comment.content)
+
+
+def mutation_key(mutation):
+    if mutation['op'] == 'like':
+        return db.Key.from_path('PostLike', PostLike.key_name_for(
+            mutation['post_id'], mutation['user_id']))
+    return db.Key(mutation['comment_key'])
+
+
+def apply_mutations_txn(post, mutations):
+    """
+        applies mutations of one post on top of the stored comments and
+        likes, skipping those already in effect. the counter changes go
+        to one shard per counter. returns {key: (before, after)} for
+        the comments and likes that changed
+    """
+    post_id = str(post.key().id())
+    keys = [mutation_key(m) for m in mutations]
+    unique_keys = list(set(keys))
+    shard_keys = [CounterShard.random_key(comments_counter(post_id)),
+                  CounterShard.random_key(likes_counter(post_id))]
+    legacy = any(m['op'] == 'like' and m['user_id'] in post.likers
+                 for m in mutations)
+    fetched = db.get(unique_keys + shard_keys +
+                     [CommentSummary.key_for(post_id)] +
+                     ([post.key()] if legacy else []))
+    state = dict(zip(unique_keys, fetched))
+    before = dict(state)
+    comment_shard, like_shard, summary = fetched[len(unique_keys):][:3]
+    stored_post = fetched[-1] if legacy else None
+    if not summary and any(m['op'] != 'like' for m in mutations):
+        summary = CommentSummary.build(post_id)
+    deleted = []
+
+    changed = set()
+    post_changed = False
+    comment_delta = like_delta = 0
+    for m, key in zip(mutations, keys):
+        op, current = m['op'], state[key]
+        if op == 'comment' and not current:
+            state[key] = Comment(
+                key=key, post_id=post_id, content=m['content'],
+                username=m['username'],
+                created=datetime.datetime.utcfromtimestamp(m['ts']))
+            summary.add(state[key])
+            comment_delta += 1
+        elif op == 'edit-comment' and current:
+            current.content = m['content']
+            summary.update(current)
+        elif op == 'delete-comment' and current:
+            state[key] = None
+            summary.remove(current, deleted)
+            deleted.append(key)
+            comment_delta -= 1
+        elif op == 'like':
+            legacy_like = stored_post and m['user_id'] in stored_post.likers
+            if m['liked'] and not (current or legacy_like):
+                state[key] = PostLike(key=key, post_id=post_id,
+                                      user_id=m['user_id'])
+                like_delta += 1
+            elif not m['liked'] and current:
+                state[key] = None
+                like_delta -= 1
+            elif not m['liked'] and legacy_like:
+                stored_post.likers.remove(m['user_id'])
+                post_changed = True
+                like_delta -= 1
+                continue
+            else:
+                continue
+        else:
+            continue
+        changed.add(key)
+
+    puts = [state[key] for key in changed if state[key]]
+    deletes = [key for key in changed if not state[key] and before[key]]
+    if comment_delta:
+        puts.append(CounterShard.add(shard_keys[0], comment_shard,
+                                     comment_delta))
+    if like_delta:
+        puts.append(CounterShard.add(shard_keys[1], like_shard, like_delta))
+    if post_changed:
+        puts.append(stored_post)
+    if any(key.kind() == 'Comment' for key in changed):
+        puts.append(summary)
+    rpc = db.delete_async(deletes) if deletes else None
+    if puts:
+        db.put(puts)
+    if rpc:
+        rpc.get_result()
+    return dict((key, (before[key], state[key])) for key in changed)
+
+
+def apply_post_mutations(post, mutations):
+    """
+        applies the queued mutations of one post in transactions of at
+        most WRITE_BEHIND_GROUPS mutations, then updates the search
+        index and caches
+    """
+    post_id = str(post.key().id())
+    changes = {}
+    for i in xrange(0, len(mutations), WRITE_BEHIND_GROUPS):
+        chunk = db.run_in_transaction_options(
+            XG_TRANSACTION, apply_mutations_txn, post,
+            mutations[i:i + WRITE_BEHIND_GROUPS])
+        for key, (before, after) in chunk.iteritems():
+            changes[key] = (changes.get(key, (before,))[0], after)
+
+    docs = []
+    for before, after in changes.itervalues():
+        if isinstance(after, Comment):
+            docs.append(SearchDoc.for_comment(after))
+        elif isinstance(before, Comment) and not after:
+            unindex_comment(before)
+    if docs:
+        index_docs(docs)
+    memcache.delete_multi([comments_counter(post_id), likes_counter(post_id)],
+                          key_prefix='counter:')
+    invalidate_post(post_id)
+    invalidate_comments(post_id)
+
+
+def apply_queued_writes():
+    """
+        leases up to WRITE_BEHIND_BATCH queued mutations, applies them
+        post by post in the order they were made and deletes the tasks
+        of the posts that succeeded. returns (applied, failed, more)
+    """
+    queue = taskqueue.Queue(WRITE_BEHIND_QUEUE)
+    tasks = queue.lease_tasks(WRITE_BEHIND_LEASE, WRITE_BEHIND_BATCH)
+    by_post = collections.defaultdict(list)
+    for task in tasks:
+        mutation = json.loads(task.payload)
+        by_post[mutation['post_id']].append((mutation['ts'], mutation, task))
+
+    post_ids = by_post.keys()
+    done = []
+    failed = 0
+    for post_id, post in zip(post_ids, Post.by_ids(post_ids)):
+        items = sorted(by_post[post_id], key=lambda item: item[0])
+        # mutations of deleted posts are dropped
+        if post:
+            try:
+                apply_post_mutations(post, [m for _, m, _ in items])
+            except db.Error:
+                logging.exception('applying writes of post %s', post_id)
+                failed += len(items)
+                continue
+        done += [task for _, _, task in items]
+    if done:
+        queue.delete_tasks(done)
+    return len(done), failed, len(tasks) == WRITE_BEHIND_BATCH
+
+
+# ---------------------------MAINTENANCE JOBS---------------------------------
+# Each job processes one batch and returns the cursor to continue from,
+# or None when it is finished. The Migrate handler chains the batches
+# through the task queue so no request comes near its deadline.
+def migrate_comments(cursor=None, batch_size=MIGRATION_BATCH_SIZE):
+    """
+        moves comments stored without a parent under comments_key()
+        for their post. returns the cursor to continue from or None
+    """
+    query = Comment.all()
+    if cursor:
+        query.with_cursor(cursor)
+    comments = query.fetch(batch_size)
+    legacy = [c for c in comments if c.parent_key() is None]
+    if legacy:
+        db.put([Comment(parent=comments_key(c.post_id),
+                        post_id=c.post_id,
+                        content=c.content,
+                        created=c.created,
+                        username=c.username) for c in legacy])
+        db.delete(legacy)
+    if len(comments) == batch_size:
+        return query.cursor()
+
+
+def migrate_likes(cursor=None, batch_size=MIGRATION_BATCH_SIZE):
+    """
+        creates PostLike entities from the likers list of each post
+        and empties the list. returns the cursor to continue from or None
+    """
+    query = Post.all()
+    if cursor:
+        query.with_cursor(cursor)
+    posts = query.fetch(batch_size)
+    likes = []
+    liked_posts = []
+    for post in posts:
+        if not post.likers:
+            continue
+        post_id = str(post.key().id())
+        for user_id in post.likers:
+            key_name = PostLike.key_name_for(post_id, user_id)
+            likes.append(PostLike(key_name=key_name, post_id=post_id,
+                                  user_id=user_id))
+        post.likers = []
+        liked_posts.append(post)
+    if likes:
+        db.put(likes)
+        db.put(liked_posts)
+    if len(posts) == batch_size:
+        return query.cursor()
+
+
+def migrate_posts(cursor=None, batch_size=MIGRATION_BATCH_SIZE):
+    """
+        moves posts stored without a parent under posts_key(), keeping
+        their numeric ids so links, comments, likes and counters stay
+        attached. returns the cursor to continue from or None
+    """
+    query = Post.all()
+    if cursor:
+        query.with_cursor(cursor)
+    posts = query.fetch(batch_size)
+    legacy = [p for p in posts if p.parent_key() is None]
+    moved = []
+    for post in legacy:
+        key = db.Key.from_path('Post', post.key().id(), parent=posts_key())
+
+        # only reuse the id if it is free under posts_key(); otherwise
+        # the post stays where it is and Post.by_id still finds it
+        state = db.allocate_id_range(key, key.id(), key.id())
+        if state != db.KEY_RANGE_EMPTY:
+            continue
+        values = dict((name, getattr(post, name))
+                      for name in post.properties().keys() +
+                      post.dynamic_properties())
+        moved.append(Post(key=key, **values))
+    if moved:
+        db.put(moved)
+        db.delete([db.Key.from_path('Post', p.key().id()) for p in moved])
+        invalidate_front_page()
+    if len(posts) == batch_size:
+        return query.cursor()
+
+
+def migrate_usernames(cursor=None, batch_size=MIGRATION_BATCH_SIZE):
+    """
+        reserves a Username for every user that does not have one yet.
+        returns the cursor to continue from or None
+    """
+    query = User.all().ancestor(users_key())
+    if cursor:
+        query.with_cursor(cursor)
+    users = query.fetch(batch_size)
+    names = {}
+    for user in users:
+        names.setdefault(Username.normalize(user.name), user)
+    existing = Username.get_by_key_name(names.keys(), parent=users_key())
+    db.put([Username(key_name=name, parent=users_key(), user=names[name])
+            for name, username in zip(names.keys(), existing)
+            if username is None])
+    if len(users) == batch_size:
+        return query.cursor()
+
+
+def migrate_author_posts(cursor=None, batch_size=MIGRATION_BATCH_SIZE):
+    """
+        lists every post under its author with an AuthorPost.
+        returns the cursor to continue from or None
+    """
+    query = Post.all()
+    if cursor:
+        query.with_cursor(cursor)
+    posts = query.fetch(batch_size)
+    authors = {}
+    entries = []
+    for post in posts:
+        if post.creator_name not in authors:
+            authors[post.creator_name] = User.by_name(post.creator_name)
+        author = authors[post.creator_name]
+        if author:
+            entries.append(AuthorPost.for_post(post, author))
+    db.put(entries)
+    if len(posts) == batch_size:
+        return query.cursor()
+
+
+def migrate_search(cursor=None, batch_size=MIGRATION_BATCH_SIZE):
+    """
+        indexes existing posts and their comments for search.
+        returns the cursor to continue from or None
+    """
+    query = Post.all()
+    if cursor:
+        query.with_cursor(cursor)
+    posts = query.fetch(batch_size)
+    docs = []
+    for post in posts:
+        docs.append(SearchDoc.for_post(post))
+        for comment in Comment.for_post(str(post.key().id())).run():
+            docs.append(SearchDoc.for_comment(comment))
+    index_docs(docs)
+    if len(posts) == batch_size:
+        return query.cursor()
+
+
+def migrate_summaries(cursor=None, batch_size=MIGRATION_BATCH_SIZE):
+    """
+        builds the CommentSummary of posts that have none, run after
+        the comments job. returns the cursor to continue from or None
+    """
+    query = Post.all()
+    if cursor:
+        query.with_cursor(cursor)
+    posts = query.fetch(batch_size)
+    post_ids = [post.key().id() for post in posts]
+    summaries = db.get([CommentSummary.key_for(post_id)
+                        for post_id in post_ids])
+
+    def build(post_id):
+        if not CommentSummary.get(CommentSummary.key_for(post_id)):
+            CommentSummary.build(post_id).put()
+
+    for post_id, summary in zip(post_ids, summaries):
+        if not summary:
+            db.run_in_transaction(build, post_id)
+            invalidate_post(post_id)
+    if len(posts) == batch_size:
+        return query.cursor()
+
+
+def purge_job(model):
+    """
+        returns a job that deletes every entity of model using
+        keys only queries and batched deletes
+    """
+    def purge(cursor=None, batch_size=PURGE_BATCH_SIZE):
+        query = model.all(keys_only=True)
+        if cursor:
+            query.with_cursor(cursor)
+        keys = query.fetch(batch_size)
+        db.delete(keys)
+        if len(keys) == batch_size:
+            return query.cursor()
+        memcache.flush_all()
+    return purge
+
+
+def json_default(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, db.Key):
+        return str(value)
+    raise TypeError(repr(value))
+
+
+def entity_to_json(entity):
+    """
+        serializes an entity with its key as one line of JSON
+    """
+    values = {}
+    for name, prop in entity.properties().iteritems():
+        # references export their key without fetching the target, any
+        # other property is read as stored. get_value_for_datastore
+        # would return now() for auto_now dates
+        if isinstance(prop, db.ReferenceProperty):
+            values[name] = prop.get_value_for_datastore(entity)
+        else:
+            values[name] = getattr(entity, name)
+    for name in entity.dynamic_properties():
+        values[name] = getattr(entity, name)
+    values['key'] = str(entity.key())
+    return json.dumps(values, default=json_default)
+
+
+DATA_MODELS = dict((model.kind(), model) for model in (
+    User, Username, Post, Comment, PostLike, AuthorPost, CounterShard,
+    SearchDoc, CommentSummary, FeedSnapshot))
+
+JOBS = {
+    'comments': migrate_comments,
+    'likes': migrate_likes,
+    'posts': migrate_posts,
+    'usernames': migrate_usernames,
+    'authorposts': migrate_author_posts,
+    'search': migrate_search,
+    'summaries': migrate_summaries,
+}
+for kind, model in DATA_MODELS.iteritems():
+    JOBS['purge-' + kind] = purge_job(model)
 
 
 # -------------------------------HANDLERS-------------------------------------
 class TestHandler(BaseHandler):
     """
         This handler is for development and debugging purposes.
-        It clears Users,Posts, and Comments in datastore
+        It queues purge jobs that clear every kind in datastore
     """
     def get(self):
-        comments = db.GqlQuery("select * from Comment")
-        posts = db.GqlQuery("select * from Post")
-        users = db.GqlQuery("select * from User")
-        for user in users:
-            user.delete()
-        for post in posts:
-            post.delete()
-        for comment in comments:
-            comment.delete()
-        self.response.write('Test passed')
+        for kind in DATA_MODELS:
+            taskqueue.add(url='/migrate', params={'job': 'purge-' + kind})
+        memcache.flush_all()
+        session_cache.local.clear()
+        self.response.write('Purge queued')
 
 
 class FrontPage(BaseHandler):
+    def render_page(self, **kw):
+        posts, prev_cursor, next_cursor = self.paginate(
+            Post.recent(), Post.recent('created'))
+        kw['liked'] = Post.prefetch(posts, kw.get('user'))
+        return self.render_str("front-page.html", posts=posts,
+                               prev_cursor=prev_cursor,
+                               next_cursor=next_cursor,
+                               page_url="/?", **kw)
+
     def get(self):
-        posts = db.GqlQuery("select * from Post order by created desc")
+        cursor = self.request.get("cursor")
+        direction = self.request.get("dir")
+        stamp = get_stamp('front')
+        if self.not_modified(['front', stamp, cursor, direction], stamp):
+            return
         if self.user:
-            self.render("front-page.html", posts=posts,
-                        user=self.user, username=self.user.name)
-        else:
-            self.render("front-page.html", posts=posts)
+            return self.write(self.render_page(user=self.user,
+                                               username=self.user.name))
+
+        # anonymous visitors all see the same page, so serve it from cache
+        key = front_page_cache_key(cursor, direction)
+        html = memcache.get(key)
+        if html is None:
+            html = self.render_page()
+            memcache.set(key, html, CACHE_TIME)
+        self.write(html)
 
 
 class Login(BaseHandler):
@@ -310,11 +2065,7 @@ class Signup(BaseHandler):
             return False
 
     def user_exists(self, username):
-        users = db.GqlQuery("select * from User")
-        for user in users:
-            if user.name == username:
-                return True
-        return False
+        return User.by_name(username) is not None
 
     def render_page(self, username="", password="", error=""):
         self.render("signup.html", username=username,
@@ -357,8 +2108,10 @@ class Signup(BaseHandler):
 
                 # store new user in database
                 # salt + hash before storing password
-                u = User.register(username, password)
-                u.put()
+                u = User.create(username, password)
+                if not u:
+                    error = "Username already exsists"
+                    return self.render_page(error=error)
                 self.login(u)
                 self.redirect('/')
 
@@ -381,24 +2134,34 @@ class NewPost(BaseHandler):
 
         subject = self.request.get("subject")
         content = self.request.get("content")
-        creator = self.request.get("creator_name")
-        p = Post(subject=subject, content=content,
-                 creator_name=creator, numLikes=0, numComments=0)
-        p.put()
-
-        # allows time for database to store new information
-        # to be displayed on front page
-        time.sleep(1)
+        p = Post(parent=posts_key(), subject=subject, content=content,
+                 creator_name=self.user.name, numLikes=0, numComments=0)
+        p.set_content(content)
+
+        def txn():
+            feed = FeedSnapshot.load()
+            p.put()
+            feed.add(p)
+            db.put([AuthorPost.for_post(p, self.user), feed])
+
+        db.run_in_transaction_options(XG_TRANSACTION, txn)
+        index_docs([SearchDoc.for_post(p)])
+        invalidate_front_page()
+        invalidate_feed()
         self.redirect("/")
 
 
 class Myposts(BaseHandler):
     def get(self):
         if self.user:
-            query = "select * from Post where creator_name='" + \
-                    self.user.name + "'order by created desc"
-            myposts = db.GqlQuery(query)
-            self.render("myposts.html", posts=myposts, user=self.user)
+            keys, prev_cursor, next_cursor = self.paginate(
+                AuthorPost.for_author(self.user),
+                AuthorPost.for_author(self.user, 'created'))
+            myposts = [post for post in
+                       Post.by_ids([key.name() for key in keys]) if post]
+            self.render("myposts.html", posts=myposts, user=self.user,
+                        prev_cursor=prev_cursor, next_cursor=next_cursor,
+                        page_url="/myposts?")
         else:
             msg = "Sign in to view your posts!"
             self.render("login.html", error=msg)
@@ -425,58 +2188,56 @@ class Logout(BaseHandler):
 class EditPost(BaseHandler):
     def get(self):
         post_id = self.request.get("post_id")
-        posts = db.GqlQuery("select * from Post")
-        subject = ""
-        content = ""
-        for post in posts:
-            if post_id == str(post.key().id()):
-                subject = post.subject
-                content = post.content
-                post_to_edit = post
-                break
-        if not self.user.name == post_to_edit.creator_name:
+        post_to_edit = self.get_post(post_id)
+        if not self.user or self.user.name != post_to_edit.creator_name:
             return self.redirect('/')
-        self.render("editpost.html", post_id=post_id, content=content,
-                    subject=subject, user=self.user)
+        self.render("editpost.html", post_id=post_id,
+                    content=post_to_edit.content,
+                    subject=post_to_edit.subject, user=self.user)
 
     def post(self):
         subject = self.request.get("subject")
         content = self.request.get("content")
-        post_id = self.request.get("post_id")
+        post_to_edit = self.get_post()
 
-        post_to_edit = None
-        posts = db.GqlQuery("select * from Post")
-        for post in posts:
-            if post_id == str(post.key().id()):
-                post_to_edit = post
-                break
-
-        if not self.user.name == post_to_edit.creator_name:
+        if not self.user or self.user.name != post_to_edit.creator_name:
             return self.redirect('/')
 
         post_to_edit.subject = subject
-        post_to_edit.content = content
-        post.put()
-        time.sleep(1)
+        post_to_edit.set_content(content)
+
+        def txn():
+            feed = FeedSnapshot.load()
+            post_to_edit.put()
+            feed.update(post_to_edit)
+            feed.put()
+
+        db.run_in_transaction_options(XG_TRANSACTION, txn)
+        index_docs([SearchDoc.for_post(post_to_edit)])
+        invalidate_post(post_to_edit.key().id())
+        invalidate_feed()
         self.redirect("/myposts")
 
 
 class DeletePost(BaseHandler):
     def get(self):
-        posts = db.GqlQuery("select * from Post")
-        post_id = self.request.get("post_id")
-
-        for post in posts:
-            if post_id == str(post.key().id()):
-                post_to_delete = post
-                if self.user.name == post_to_delete.creator_name:
-                    post.delete()
-                    time.sleep(1)
-                    return self.redirect("/myposts")
+        post_to_delete = self.get_post()
+        if self.user and self.user.name == post_to_delete.creator_name:
+            def txn():
+                feed = FeedSnapshot.load()
+                feed.remove(post_to_delete)
+                db.delete([post_to_delete.key(),
+                           AuthorPost.key_for(post_to_delete, self.user)])
+                feed.put()
+
+            db.run_in_transaction_options(XG_TRANSACTION, txn)
+            unindex_post(post_to_delete.key().id())
+            invalidate_post(post_to_delete.key().id())
+            invalidate_feed()
+            return self.redirect("/myposts")
 
         msg = "Sign in to delete your posts!"
         self.render("login.html", error=msg)
-        print post_id
 
 
 class Like(BaseHandler):
@@ -484,146 +2245,179 @@ class Like(BaseHandler):
         if not self.user:
             self.redirect('/login')
             return
-        post_id = self.request.get("post_id")
-        posts = db.GqlQuery("select * from Post")
-        post_to_like = None
-        posted = False
-        for post in posts:
-            if post_id == str(post.key().id()):
-                post_to_like = post
-                break
-        if self.user:
-            if post_to_like.creator_name == self.user.name:
-                self.redirect('/')
-                return
-            user_id = str(self.user.key().id())
-            print("user_id: " + user_id)
-            likers = post_to_like.likers
-            for liker in likers:
-
-                # if post has already been liked by current user
-                if user_id == liker:
-                    posted = True
-                    post_to_like.likers.remove(user_id)
-                    post_to_like.numLikes -= 1
-                    post_to_like.put()
-                    self.redirect('/')
-                    time.sleep(1)
-                    break
-        if not posted:
-            post.likers.append((user_id))
-            post_to_like.numLikes += 1
-            post_to_like.put()
-            time.sleep(1)
+        post_to_like = self.get_post()
+        if post_to_like.creator_name == self.user.name:
             self.redirect('/')
+            return
+        post_key = post_to_like.key()
+        post_id = str(post_key.id())
+        user_id = str(self.user.key().id())
+        like_key = db.Key.from_path(
+            'PostLike', PostLike.key_name_for(post_id, user_id))
+        counter = likes_counter(post_id)
+        legacy_like = user_id in post_to_like.likers
+
+        if WRITE_BEHIND:
+            liked = post_key.id() in PostLike.liked_post_ids([post_to_like],
+                                                             self.user)
+            if queue_write({'op': 'like', 'post_id': post_id,
+                            'user_id': user_id, 'liked': not liked},
+                           post_id, user_id, not liked):
+                bump_count_cache(counter, -1 if liked else 1)
+                invalidate_post(post_key.id())
+            return self.redirect('/')
+
+        def toggle_like():
+            shard_key = CounterShard.random_key(counter)
+            like, shard = db.get([like_key, shard_key])
+
+            # if post has already been liked by current user
+            if like:
+                rpc = db.delete_async(like)
+                delta = -1
+            elif legacy_like:
+                post = db.get(post_key)
+                post.likers.remove(user_id)
+                rpc = db.put_async(post)
+                delta = -1
+            else:
+                rpc = db.put_async(PostLike(key=like_key, post_id=post_id,
+                                            user_id=user_id))
+                delta = 1
+            db.put(CounterShard.add(shard_key, shard, delta))
+            rpc.get_result()
+            return delta
+
+        delta = db.run_in_transaction_options(XG_TRANSACTION, toggle_like)
+        update_count_cache(counter, delta)
+        invalidate_post(post_key.id())
+        self.redirect('/')
 
 
 class Comments(BaseHandler):
     def get(self):
         post_id = str(self.request.get("post_id"))
-        comments = db.GqlQuery("select * from Comment order by created desc")
-        posts = db.GqlQuery("select * from Post")
-        for post in posts:
-            if post_id == str(post.key().id()):
-                post_to_pass = post
-                break
-        commentList = []
-        for comment in comments:
-            if comment.post_id == post_id:
-                commentList.append(comment)
-        self.render("comments.html", comments=commentList,
-                    post=post, user=self.user)
+        post = self.get_post(post_id)
+        stamp = get_stamp('comments:%s' % post_id)
+        if self.not_modified(['comments', post_id, stamp, post.last_modified,
+                              self.request.get("cursor"),
+                              self.request.get("dir")],
+                             max(stamp, post.last_modified)):
+            return
+        comments, prev_cursor, next_cursor = self.paginate(
+            Comment.for_post(post_id), Comment.for_post(post_id, 'created'))
+        self.render("comments.html", comments=comments,
+                    post=post, user=self.user,
+                    prev_cursor=prev_cursor, next_cursor=next_cursor,
+                    page_url="/comments?post_id=%s&" % post_id)
 
 
 class NewComment(BaseHandler):
+    def add_comment(self, comment):
+        """
+            stores comment and bumps the post's comment counter
+            in one transaction
+        """
+        counter = comments_counter(comment.post_id)
+        if WRITE_BEHIND:
+            if queue_new_comment(comment):
+                bump_count_cache(counter, 1)
+                invalidate_post(comment.post_id)
+            return
+
+        def txn():
+            shard_key = CounterShard.random_key(counter)
+            shard, summary = db.get([shard_key, CommentSummary.key_for(
+                comment.post_id)])
+            summary = summary or CommentSummary.build(comment.post_id)
+            summary.add(comment)
+            db.put([comment, summary, CounterShard.add(shard_key, shard)])
+
+        db.run_in_transaction_options(XG_TRANSACTION, txn)
+        update_count_cache(counter, 1)
+        index_docs([SearchDoc.for_comment(comment)])
+        invalidate_post(comment.post_id)
+        invalidate_comments(comment.post_id)
+
     def get(self):
         if not self.user:
             self.redirect('/login')
             return
         comment = self.request.get("comment")
         post_id = self.request.get("post_id")
-        posts = db.GqlQuery("select * from Post")
-        for post in posts:
-            if post_id == str(post.key().id()):
-                post_to_comment = post
-                break
+        self.get_post(post_id)
 
-        comment = Comment(content=comment, post_id=post_id,
+        comment = Comment(key=Comment.allocate_key(post_id),
+                          content=comment, post_id=post_id,
                           username=self.user.name)
-        comment.put()
-        post_to_comment.numComments += 1
-        post_to_comment.put()
-        time.sleep(1)
-        self.redirect("/post?post_id={{p.key().id()}}")
+        self.add_comment(comment)
+        self.redirect("/post?post_id=" + post_id)
 
     def post(self):
         comment = self.request.get("comment")
         post_id = self.request.get("post_id")
-        posts = db.GqlQuery("select * from Post")
-        for post in posts:
-            if post_id == str(post.key().id()):
-                post_to_comment = post
-                break
+        self.get_post(post_id)
 
-        comment = Comment(content=comment, post_id=post_id)
-        comment.put()
-        post_to_comment.numComments += 1
-        post_to_comment.put()
-        time.sleep(1)
-        self.redirect("/post?post_id={{p.key().id()}}")
+        comment = Comment(key=Comment.allocate_key(post_id),
+                          content=comment, post_id=post_id)
+        self.add_comment(comment)
+        self.redirect("/post?post_id=" + post_id)
 
 
 class PostPage(BaseHandler):
     def get(self):
-        post_id = self.request.get("post_id")
-        post_to_view = None
-
-        posts = db.GqlQuery("select * from Post")
-        comments = db.GqlQuery("select * from Comment order by created desc")
-        self.write(comments)
-        for post in posts:
-            if post_id == str(post.key().id()):
-                post_to_view = post
-        self.render("permalink.html", user=self.user, post=post)
+        post_to_view = self.get_post()
+        post_id = post_to_view.key().id()
+        stamp = get_stamp('post:%s' % post_id)
+        if self.not_modified(['post', post_id, stamp,
+                              post_to_view.last_modified],
+                             max(stamp, post_to_view.last_modified)):
+            return
+        self.render("permalink.html", user=self.user, post=post_to_view)
 
 
 class DeleteComment(BaseHandler):
     def get(self):
         comment_id = self.request.get("comment_id")
         post_id = self.request.get("post_id")
-        comment_to_delete = None
-        post_to_alter = None
-        comments = db.GqlQuery("select * from Comment")
-        posts = db.GqlQuery("select * from Post")
-
-        for post in posts:
-            if post_id == str(post.key().id()):
-                post_to_alter = post
-
-        for comment in comments:
-            if comment_id == str(comment.key().id()):
-                comment_to_delete = comment
-
-        if self.user.name == comment.username:
-            print ("self.user.name: "+self.user.name)
-            print ("comment.username: "+comment.username)
-            post_to_alter.numComments -= 1
-            post.put()
-            comment_to_delete.delete()
-            time.sleep(1)
+        _, comment_to_delete = self.get_post_and_comment(post_id,
+                                                         comment_id)
+
+        if self.user and self.user.name == comment_to_delete.username:
+            counter = comments_counter(post_id)
+            if WRITE_BEHIND:
+                comment_key = str(comment_to_delete.key())
+                if queue_write({'op': 'delete-comment', 'post_id': post_id,
+                                'comment_key': comment_key}, comment_key):
+                    bump_count_cache(counter, -1)
+                    invalidate_post(post_id)
+                return self.redirect("/comments?post_id="+post_id)
+
+            def txn():
+                shard_key = CounterShard.random_key(counter)
+                delete_rpc = db.delete_async(comment_to_delete)
+                shard, summary = db.get([shard_key,
+                                         CommentSummary.key_for(post_id)])
+                summary = summary or CommentSummary.build(post_id)
+                summary.remove(comment_to_delete)
+                db.put([summary, CounterShard.add(shard_key, shard, -1)])
+                delete_rpc.get_result()
+
+            db.run_in_transaction_options(XG_TRANSACTION, txn)
+            update_count_cache(counter, -1)
+            unindex_comment(comment_to_delete)
+            invalidate_post(post_id)
+            invalidate_comments(post_id)
             return self.redirect("/comments?post_id="+post_id)
+        self.redirect("/login")
 
 
 class EditComment(BaseHandler):
     def get(self):
         comment_id = self.request.get("comment_id")
-        post_id = post_id = self.request.get("post_id")
-        comments = db.GqlQuery("select * from Comment")
-        for comment in comments:
-            if comment_id == str(comment.key().id()):
-                comment_to_edit = comment
-                break
-        if not comment_to_edit.username == self.user.name:
+        post_id = self.request.get("post_id")
+        comment_to_edit = self.get_comment(post_id, comment_id)
+        if not self.user or comment_to_edit.username != self.user.name:
             return self.redirect("/login")
 
         self.render("editcomment.html", user=self.user,
@@ -631,21 +2425,178 @@ class EditComment(BaseHandler):
 
     def post(self):
         comment_id = self.request.get("comment_id")
-        post_id = post_id = self.request.get("post_id")
+        post_id = self.request.get("post_id")
         new_comment = self.request.get("new_comment")
-        comments = db.GqlQuery("select * from Comment")
-        for comment in comments:
-            if comment_id == str(comment.key().id()):
-                comment_to_edit = comment
-                break
-        if not comment_to_edit.username == self.user.name:
+        comment_to_edit = self.get_comment(post_id, comment_id)
+        if not self.user or comment_to_edit.username != self.user.name:
             return self.redirect("/login")
 
-        comment_to_edit.content = new_comment
-        comment_to_edit.put()
-        time.sleep(1)
+        if WRITE_BEHIND:
+            comment_key = str(comment_to_edit.key())
+            if queue_write({'op': 'edit-comment', 'post_id': post_id,
+                            'comment_key': comment_key,
+                            'content': new_comment},
+                           comment_key, new_comment):
+                invalidate_post(post_id)
+                invalidate_comments(post_id)
+            return self.redirect("/comments?post_id="+post_id)
+
+        def txn():
+            summary = CommentSummary.get(CommentSummary.key_for(post_id))
+            comment_to_edit.content = new_comment
+            if summary:
+                summary.update(comment_to_edit)
+                db.put([comment_to_edit, summary])
+            else:
+                comment_to_edit.put()
+
+        db.run_in_transaction_options(XG_TRANSACTION, txn)
+        index_docs([SearchDoc.for_comment(comment_to_edit)])
+        invalidate_post(post_id)
+        invalidate_comments(post_id)
         return self.redirect("/comments?post_id="+post_id)
 
+
+class Feed(BaseHandler):
+    """
+        Serves /feed.atom and /feed.json from the FeedSnapshot. The
+        rendered feed is cached in memcache under the feed stamp, so
+        polling costs a 304 or a single memcache get
+    """
+    def get(self, fmt):
+        stamp = get_stamp('feed')
+        if self.not_modified(['feed', fmt, stamp], stamp):
+            return
+        base_url = self.request.host_url
+        key = 'feed:%s:%s:%s' % (fmt, base_url, stamp.isoformat())
+        body = memcache.get(key)
+        if body is None:
+            body = FeedSnapshot.current().render(fmt, base_url)
+            memcache.set(key, body, CACHE_TIME)
+        self.response.headers['Content-Type'] = \
+            FEED_FORMATS[fmt] + '; charset=utf-8'
+        self.write(body)
+
+
+class Search(BaseHandler):
+    def get(self):
+        q = self.request.get("q")
+        page = self.request.get("page")
+        page = int(page) if page.isdigit() else 0
+        post_ids, has_more = search(q, page)
+        posts = [post for post in Post.by_ids(post_ids) if post]
+        self.render("search.html", user=self.user, q=q, posts=posts,
+                    q_param=urllib.quote(q.encode('utf-8')),
+                    page=page, has_more=has_more)
+
+
+class Migrate(BaseHandler):
+    """
+        This handler is for maintenance purposes.
+        It runs one batch of a named maintenance job and queues the
+        next batch until the job is finished
+    """
+    def get(self):
+        job = self.request.get("job")
+        if job not in JOBS:
+            self.abort(404)
+        cursor = JOBS[job](self.request.get("cursor") or None)
+        if cursor:
+            taskqueue.add(url='/migrate',
+                          params={'job': job, 'cursor': cursor})
+        self.response.write('Batch done')
+
+    def post(self):
+        self.get()
+
+
+class ApplyWrites(BaseHandler):
+    """
+        This handler is for maintenance purposes.
+        It runs from the write-flush queue, applies one batch of queued
+        comment and like mutations and queues itself again while more
+        are waiting. Failed batches make the task fail so it is retried
+    """
+    def post(self):
+        applied, failed, more = apply_queued_writes()
+        if more:
+            taskqueue.add(queue_name=WRITE_FLUSH_QUEUE, url='/_writes')
+        if failed:
+            self.abort(500)
+        self.response.write('%d applied' % applied)
+
+
+class Export(BaseHandler):
+    """
+        This handler is for maintenance purposes.
+        It streams one batch of a kind as JSON lines and sends the
+        cursor for the next batch in the X-Next-Cursor header, so any
+        number of entities can be exported one request at a time
+    """
+    def get(self):
+        model = DATA_MODELS.get(self.request.get("kind"))
+        if not model:
+            self.abort(404)
+        query = model.all()
+        cursor = self.request.get("cursor")
+        try:
+            if cursor:
+                query.with_cursor(cursor)
+            entities = query.run(limit=EXPORT_BATCH_SIZE,
+                                 batch_size=EXPORT_BATCH_SIZE)
+            self.response.headers['Content-Type'] = 'application/x-ndjson'
+            count = 0
+            for entity in entities:
+                self.write(entity_to_json(entity) + '\n')
+                count += 1
+        except (db.BadRequestError, db.BadValueError):
+            self.abort(400)
+        if count == EXPORT_BATCH_SIZE:
+            self.response.headers['X-Next-Cursor'] = query.cursor()
+
+
+class SessionStats(BaseHandler):
+    """
+        This handler is for monitoring purposes.
+        Shows hit and miss counts of this instance's user session cache
+    """
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.write(json.dumps(session_cache.stats()))
+
+
+class TemplateStats(BaseHandler):
+    """
+        This handler is for monitoring purposes.
+        Shows render counts and times of this instance's templates
+    """
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.write(json.dumps(template_engine.stats()))
+
+
+class Stats(BaseHandler):
+    """
+        This handler is for monitoring purposes.
+        Shows the mean datastore RPCs, entities and times per route of
+        this instance together with the template and session stats
+    """
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.write(json.dumps({'routes': request_stats.stats(),
+                               'templates': template_engine.stats(),
+                               'sessions': session_cache.stats()},
+                              sort_keys=True))
+
+
+class Warmup(BaseHandler):
+    """
+        Handles App Engine warmup requests. Loading this module already
+        compiles the templates, so there is nothing left to do
+    """
+    def get(self):
+        self.response.write('Warm')
+
 # -------------------------------Handler Mappings------------------------------
 app = webapp2.WSGIApplication([
     ('/', FrontPage),
@@ -663,5 +2614,14 @@ app = webapp2.WSGIApplication([
     ('/like', Like),
     ('/deletecomment', DeleteComment),
     ('/editcomment', EditComment),
-    ('/post', PostPage)
+    ('/post', PostPage),
+    ('/search', Search),
+    (r'/feed\.(atom|json)', Feed),
+    ('/migrate', Migrate),
+    ('/export', Export),
+    ('/_writes', ApplyWrites),
+    ('/_stats', Stats),
+    ('/_stats/sessions', SessionStats),
+    ('/_stats/templates', TemplateStats),
+    ('/_ah/warmup', Warmup)
 ], debug=True)
\ No newline at end of file
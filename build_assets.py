@@ -0,0 +1,73 @@
+# Description: Minifies the files in static/ and writes fingerprinted
+# copies to static_build/, which app.yaml serves under /assets with a
+# far-future expiration. blog.asset_url reads asset_manifest.json, kept
+# at the app root because files under static handlers cannot be read by
+# the app, to link the fingerprinted names.
+# Run it before deploying: python build_assets.py
+# Delete static_build/ and asset_manifest.json to go back to serving
+# static/ directly.
+
+import os
+import re
+import json
+import shutil
+import hashlib
+
+root = os.path.dirname(os.path.abspath(__file__))
+static_dir = os.path.join(root, 'static')
+asset_dir = os.path.join(root, 'static_build')
+manifest_path = os.path.join(root, 'asset_manifest.json')
+
+
+def minify_css(css):
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = re.sub(r':\s+', ':', css)
+    return css.replace(';}', '}').strip()
+
+
+def minify_js(js):
+    """
+        only drops indentation and blank lines, anything more needs
+        a real parser
+    """
+    lines = (line.strip() for line in js.splitlines())
+    return '\n'.join(line for line in lines if line)
+
+
+MINIFIERS = {'.css': minify_css, '.js': minify_js}
+
+
+def build_asset(name, data):
+    """
+        minifies data and writes it as name.<hash>.ext,
+        returns the fingerprinted name
+    """
+    base, ext = os.path.splitext(name)
+    if ext in MINIFIERS:
+        data = MINIFIERS[ext](data.decode('utf-8')).encode('utf-8')
+    hashed = '%s.%s%s' % (base, hashlib.md5(data).hexdigest()[:12], ext)
+    path = os.path.join(asset_dir, hashed)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(data)
+    return hashed
+
+
+if __name__ == '__main__':
+    if os.path.isdir(asset_dir):
+        shutil.rmtree(asset_dir)
+    os.makedirs(asset_dir)
+
+    manifest = {}
+    for dirpath, _, filenames in os.walk(static_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, static_dir).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                manifest[name] = build_asset(name, f.read())
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
@@ -0,0 +1,21 @@
+# Description: Compiles the jinja2 templates in templates/ into python
+# modules that blog.py loads instead of parsing the template files.
+# Run it before deploying: python compile_templates.py
+# Delete templates_compiled/ to go back to loading templates directly.
+
+import os
+import shutil
+import jinja2
+
+root = os.path.dirname(os.path.abspath(__file__))
+template_dir = os.path.join(root, 'templates')
+compiled_template_dir = os.path.join(root, 'templates_compiled')
+
+if __name__ == '__main__':
+    if os.path.isdir(compiled_template_dir):
+        shutil.rmtree(compiled_template_dir)
+
+    # options must match the environment built in blog.TemplateEngine
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir),
+                             autoescape=True)
+    env.compile_templates(compiled_template_dir, zip=None)